@@ -1,14 +1,35 @@
+import http.client
+import json
+import logging
+import random
 import requests
 import re
 import os
+import threading
+import time
+import uuid
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from urllib.parse import urlencode, urlsplit
 
 app = Flask(__name__)
 
 PROXY_URL = os.getenv("PROXY_URL")
 API_KEY = os.getenv("API_KEY", "secret123")
 
+# Fraction of requests written to the trace log, the decision is propagated to the proxy
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "gatekeeper_trace.log")
+
+# The file handler is attached when the server starts, not on import
+trace_logger = logging.getLogger("trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+
+# Size of the chunks forwarded to the proxy by bulk loads
+BULK_CHUNK_SIZE = 64 * 1024
+IDENTIFIER = re.compile(r"^\w+$")
+
 # SQLs commands to prevent the user from performing
 DANGEROUS = [
   r"drop\s+table",
@@ -18,6 +39,111 @@ DANGEROUS = [
 ]
 
 
+class StageTimer:
+  """
+  Record the duration of consecutive request stages using a monotonic clock.
+  """
+
+  def __init__(self):
+    self.timings = []
+    self._last = time.perf_counter()
+
+  def mark(self, stage):
+    """
+    Close the current stage and start the next one.
+    Args:
+      stage (str): Name of the stage that just ended.
+    Returns:
+      None
+    """
+    now = time.perf_counter()
+    self.timings.append((stage, (now - self._last) * 1000))
+    self._last = now
+
+  def server_timing(self):
+    """
+    Format the recorded stages as a Server-Timing header value.
+    Returns:
+      str: Header value such as 'select;dur=0.12, execute;dur=3.40'.
+    """
+    return ", ".join(f"{stage};dur={dur:.2f}" for stage, dur in self.timings)
+
+
+def traced_response(body, status, timer, trace_id, sampled):
+  """
+  Encode a JSON response, attach the trace headers and log the trace if sampled.
+  Args:
+    body (dict): JSON body of the response.
+    status (int): HTTP status code.
+    timer (StageTimer): Timer holding the stages of the request.
+    trace_id (str): Trace ID of the request.
+    sampled (bool): Whether the request is written to the trace log.
+  Returns:
+    Flask Response: JSON response with Server-Timing and X-Trace-Id headers.
+  """
+  resp = jsonify(body)
+  resp.status_code = status
+  timer.mark("encode")
+
+  resp.headers["Server-Timing"] = timer.server_timing()
+  resp.headers["X-Trace-Id"] = trace_id
+
+  if sampled:
+    trace_logger.info(json.dumps({
+      "trace_id": trace_id,
+      "ts": time.time(),
+      "status": status,
+      "timings": {stage: round(dur, 3) for stage, dur in timer.timings}
+    }))
+
+  return resp
+
+
+def parse_server_timing(header):
+  """
+  Parse a Server-Timing header value into (stage, duration) pairs.
+  Args:
+    header (str): Header value returned by the proxy.
+  Returns:
+    list[tuple(str, float)]: Stage names and durations in milliseconds.
+  """
+  timings = []
+  for entry in filter(None, (e.strip() for e in (header or "").split(","))):
+    name, _, params = entry.partition(";")
+    dur = 0.0
+    for param in params.split(";"):
+      key, _, value = param.strip().partition("=")
+      if key == "dur":
+        try:
+          dur = float(value)
+        except ValueError:
+          pass
+    timings.append((name, dur))
+  return timings
+
+
+def send_chunked(conn, stream):
+  """
+  Forward a request body to an open HTTP connection with chunked transfer encoding.
+  Runs in its own thread so the proxy's response can be relayed during the upload.
+  Args:
+    conn (http.client.HTTPConnection): Connection whose request headers were sent.
+    stream (file-like): Body of the incoming request.
+  Returns:
+    None
+  """
+  try:
+    while True:
+      chunk = stream.read(BULK_CHUNK_SIZE)
+      if not chunk:
+        break
+      conn.send(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+    conn.send(b"0\r\n\r\n")
+  except Exception as e:
+    # The proxy may answer (and close the connection) before the whole body is sent
+    print(f"Bulk upload interrupted: {e}")
+
+
 def is_safe(sql):
   """
   Check whether an SQL query string contains any dangerous patterns.
@@ -73,23 +199,107 @@ def handle_request():
   Returns:
     Flask Response: JSON query result if valid and authorized, or an error response.
   """
+  timer = StageTimer()
+  trace_id = uuid.uuid4().hex
+  sampled = random.random() < TRACE_SAMPLE_RATE
+
   headers = request.headers
   key = headers.get("x-api-key")
 
   if key != API_KEY:
-    return jsonify({"error": "Unauthorized"}), 403
+    timer.mark("validate")
+    return traced_response({"error": "Unauthorized"}, 403, timer, trace_id, sampled)
 
-  body = request.json
+  body = request.get_json(silent=True) or {}
   sql = body.get("query")
 
   if not sql:
-    return jsonify({"error": "No query provided"}), 400
+    timer.mark("validate")
+    return traced_response({"error": "No query provided"}, 400, timer, trace_id, sampled)
 
   if not is_safe(sql):
-    return jsonify({"error": "Unsafe query"}), 400
+    timer.mark("validate")
+    return traced_response({"error": "Unsafe query"}, 400, timer, trace_id, sampled)
+  timer.mark("validate")
 
-  resp = requests.post(f"{PROXY_URL}/query", json={"query": sql}).json()
-  return jsonify(resp)
+  try:
+    proxy_resp = requests.post(
+      f"{PROXY_URL}/query",
+      json={"query": sql},
+      headers={"X-Trace-Id": trace_id, "X-Trace-Sampled": "1" if sampled else "0"}
+    )
+    result = proxy_resp.json()
+  except (requests.RequestException, ValueError) as e:
+    timer.mark("proxy")
+    return traced_response({"error": f"Proxy error: {e}"}, 502, timer, trace_id, sampled)
+  timer.mark("proxy")
+
+  # Time spent on the network and in Flask, outside of the proxy's own stages
+  proxy_timings = parse_server_timing(proxy_resp.headers.get("Server-Timing"))
+  round_trip = timer.timings[-1][1]
+  timer.timings[-1] = ("hop", max(round_trip - sum(dur for _, dur in proxy_timings), 0.0))
+  timer.timings += [(f"proxy-{stage}", dur) for stage, dur in proxy_timings]
+
+  return traced_response(result, 200, timer, trace_id, sampled)
+
+
+@app.route("/bulk/<table>", methods=["POST"])
+def bulk_load(table):
+  """
+  Stream a CSV or NDJSON body to the proxy bulk loader without buffering it.
+  Returns:
+    Flask Response: NDJSON progress stream returned by the proxy, or an error response.
+  """
+  key = request.headers.get("x-api-key")
+  if key != API_KEY:
+    return jsonify({"error": "Unauthorized"}), 403
+
+  if not IDENTIFIER.match(table):
+    return jsonify({"error": "Invalid table name"}), 400
+
+  trace_id = uuid.uuid4().hex
+  proxy = urlsplit(PROXY_URL)
+  conn = http.client.HTTPConnection(proxy.hostname, proxy.port or 80)
+  upload = None
+
+  try:
+    conn.putrequest("POST", f"{proxy.path.rstrip('/')}/bulk/{table}?{urlencode(request.args)}")
+    conn.putheader("Transfer-Encoding", "chunked")
+    if request.content_type:
+      conn.putheader("Content-Type", request.content_type)
+    conn.putheader("X-Trace-Id", trace_id)
+    conn.endheaders()
+
+    upload = threading.Thread(target=send_chunked, args=(conn, request.stream), daemon=True)
+    upload.start()
+    proxy_resp = conn.getresponse()
+  except (http.client.HTTPException, OSError) as e:
+    conn.close()
+    if upload:
+      upload.join()
+    return jsonify({"error": f"Proxy error: {e}"}), 502
+
+  def relay():
+    try:
+      while True:
+        chunk = proxy_resp.read1(BULK_CHUNK_SIZE)
+        if not chunk:
+          break
+        yield chunk
+    except (http.client.HTTPException, OSError) as e:
+      yield json.dumps({"error": f"Proxy error: {e}"}).encode() + b"\n"
+    finally:
+      conn.close()
+      upload.join()
+
+  return Response(
+    relay(),
+    status=proxy_resp.status,
+    content_type=proxy_resp.getheader("Content-Type"),
+    headers={"X-Trace-Id": trace_id}
+  )
 
 
-app.run(host="0.0.0.0", port=5000)
+if __name__ == "__main__":
+  trace_logger.addHandler(logging.FileHandler(TRACE_LOG_PATH))
+  app.run(host="0.0.0.0", port=5000)
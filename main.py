@@ -30,15 +30,19 @@ def main():
   manager = launch_instance(instance_name='manager', type='t2.micro', user_data=sakila_script)
 
   logger.info('[STEP 2] Launching worker instances')
-  worker1 = launch_instance(instance_name="worker-1", type='t2.micro', user_data=sakila_script)
-  worker2 = launch_instance(instance_name="worker-2", type='t2.micro', user_data=sakila_script)
+  mysql_script = read_script(MYSQL_SCRIPT_PATH)
+  worker1 = launch_instance(instance_name="worker-1", type='t2.micro', user_data=mysql_script)
+  worker2 = launch_instance(instance_name="worker-2", type='t2.micro', user_data=mysql_script)
   
-  logger.info('[STEP 3] Check Sakila installation on instances')
+  logger.info('[STEP 3] Check Sakila installation on manager')
   instances = [manager, worker1, worker2]
-  check_sakila_installation(instances)
+  check_sakila_installation([manager])
 
-  logger.info('[STEP 4] Configure manager and workers for replication')
-  configure_db_for_replication(instances)
+  logger.info('[STEP 4] Configure manager and seed workers from a snapshot of it')
+  workers = configure_db_for_replication(instances)
+  if len(workers) < len(instances) - 1:
+    logger.warning(f'Only {len(workers)} worker(s) could be seeded, the others are not registered with the proxy')
+  workers_ips = ",".join(worker['private_ip'] for worker in workers)
 
   logger.info('[STEP 5] Setup proxy')
   proxy_user_data = """#!/bin/bash
@@ -50,7 +54,7 @@ def main():
   run_flask_server(
     ip=proxy['public_ip'],
     filename='proxy.py',
-    env_variables=f"MANAGER_IP={manager['private_ip']} WORKERS_IPS='{worker1['private_ip']},{worker2['private_ip']}' MODE='custom'"
+    env_variables=f"MANAGER_IP={manager['private_ip']} WORKERS_IPS='{workers_ips}' MODE='custom' API_KEY=secret123"
   )
   
   logger.info('[STEP 6] Setup Gatekeeper')
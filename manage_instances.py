@@ -1,12 +1,34 @@
+import argparse
 import boto3
+import ipaddress
 import paramiko
+import re
+import requests
 
 from botocore.exceptions import ClientError
 from paramiko import SSHClient
+from concurrent.futures import ThreadPoolExecutor
 from scp import SCPClient
 from typing import List
 
 UBUNTU_AMI = 'ami-0ecb62995f68bb549'
+MYSQL_SCRIPT_PATH = './user_data/mysql_install.sh'
+
+# Consistent snapshot of the manager taken by mydumper: --trx-consistency-only holds a global
+# read lock only while its threads open their transactions and records the matching binlog
+# coordinates in the metadata file. The compressed dump is written once on the manager,
+# served to the replicas over the private network and loaded there in parallel by myloader.
+SNAPSHOT_DIR = '/tmp/snapshot'
+SNAPSHOT_FILE = 'sakila.tar'
+SNAPSHOT_PORT = 8080
+SNAPSHOT_THREADS = 4
+SNAPSHOT_COMMAND = (
+  f"sudo rm -rf {SNAPSHOT_DIR} && sudo mydumper -u root -p rootpass -B sakila --trx-consistency-only "
+  f"--threads {SNAPSHOT_THREADS} --compress --triggers --routines --events -o {SNAPSHOT_DIR}/sakila "
+  f"&& sudo tar -C {SNAPSHOT_DIR} -cf {SNAPSHOT_DIR}/{SNAPSHOT_FILE} sakila"
+)
+LOADER_THREADS = 4
+
 ec2 = boto3.client('ec2')
 
 def create_ssh_client(ip, key_path="log8415-final.pem", username="ubuntu") -> SSHClient:
@@ -89,6 +111,31 @@ def ensure_ports_open(ec2, sg_id, ports):
     print(f"Error while updating security group {sg_id}: {e}")
 
 
+def ensure_port_open_within_group(ec2, sg_id, port):
+  """
+  Ensure that a port is reachable from the instances of the security group only.
+  Args:
+    ec2 (boto3.client): EC2 client instance for AWS operations
+    sg_id (str): Id of the security group to modify
+    port (int): Port which needs to be opened
+  Returns: None
+  """
+  try:
+    ec2.authorize_security_group_ingress(
+      GroupId=sg_id,
+      IpPermissions=[{
+        "IpProtocol": "tcp",
+        "FromPort": port,
+        "ToPort": port,
+        "UserIdGroupPairs": [{"GroupId": sg_id}]
+      }]
+    )
+    print(f"Added inbound rule for port {port} within SG {sg_id}")
+  except ClientError as e:
+    if "InvalidPermission.Duplicate" not in str(e):
+      print(f"Error while updating security group {sg_id}: {e}")
+
+
 def get_default_resources(ec2, verbose=False):
   """
   Retrieve default AWS VPC resources (VPC, subnet, and security group),
@@ -119,6 +166,8 @@ def get_default_resources(ec2, verbose=False):
   # Open all required ports
   ports_to_open = [22, 80, 3306, 5000]
   ensure_ports_open(ec2, default_sg_id, ports_to_open)
+  # The snapshot served to the replicas must not be reachable from the internet
+  ensure_port_open_within_group(ec2, default_sg_id, SNAPSHOT_PORT)
     
   if verbose:
     print(f"default VPC: {default_vpc_id}")
@@ -216,26 +265,25 @@ def run_ssh_commands(host_ip: str, commands: List) -> None:
   client.close()
 
 
-def get_binary_log_coords(host_ip: str):
+def run_ssh_command_and_wait(host_ip: str, command: str) -> int:
   """
-  Retrieve the current MySQL binary log file name and position
-  from a remote host via SSH.
+  Run a single, possibly long, command over SSH and block until it exits.
   Args:
-    host_ip (str): Public or private IP address of the MySQL master server.
+    host_ip (str): Public IP address of the remote host to connect to.
+    command (str): Shell command to execute on the remote machine.
   Returns:
-    tuple (log_file: str, log_pos: int): The current binary log filename and position, used for replication setup.
+    int: Exit status of the remote command.
   """
   client = create_ssh_client(host_ip)
-  stdin, stdout, stderr = client.exec_command(
-    "sudo mysql -uroot -prootpass -N -e 'SHOW MASTER STATUS;'"
-  )
-  output = stdout.read().decode("utf-8").strip().split("\t")
-  # Columns: File  Position  Binlog_Do_DB  Binlog_Ignore_DB ...
-  log_file = output[0]
-  log_pos = int(output[1])
+  _, stdout, stderr = client.exec_command(command)
+  status = stdout.channel.recv_exit_status()
+  err = stderr.read().decode("utf-8")
+  if status != 0 and err:
+    print(err)
   client.close()
 
-  return log_file, log_pos
+  return status
+
 
 def check_sakila_installation(instances) -> None:
   """
@@ -253,55 +301,283 @@ def check_sakila_installation(instances) -> None:
   for instance in instances:
     run_ssh_commands(instance['public_ip'], commands)
 
-def configure_db_for_replication(instances) -> None:
-  source_ip = [inst['private_ip'] for inst in instances if inst['is_master']]
-  replica_ips = [inst['private_ip'] for inst in instances if not inst['is_master']]
-  count = 1
-
-  log_file = ''
-  log_pos = ''
+def replication_user_commands(replica_ip: str) -> List:
+  """
+  Build the commands creating the replication user of a replica on the manager.
+  Args:
+    replica_ip (str): Private IP address of the replica.
+  Returns:
+    List[str]: Commands to run on the manager.
+  """
+  return [
+    f"sudo mysql -u root -prootpass -e \"CREATE USER IF NOT EXISTS 'repl'@'{replica_ip}' IDENTIFIED WITH mysql_native_password BY 'replpass';\"",
+    f"sudo mysql -u root -prootpass -e \"GRANT REPLICATION SLAVE ON *.* TO 'repl'@'{replica_ip}';\"",
+  ]
 
-  for instance in instances:
-    commands = []
 
-    if instance['is_master']:
-      commands = [
-        f"sudo sed -i 's/^bind-address.*/bind-address={source_ip[0]}/' /etc/mysql/mysql.conf.d/mysqld.cnf",
+def replica_config_commands(server_id: int) -> List:
+  """
+  Build the commands enabling binary and relay logs on a replica.
+  Args:
+    server_id (int): Unique MySQL server id of the replica.
+  Returns:
+    List[str]: Commands to run on the replica.
+  """
+  return [
 f"""sudo bash -c 'cat >> /etc/mysql/mysql.conf.d/mysqld.cnf <<EOF
-server-id={count}
+server-id={server_id}
 log_bin=/var/log/mysql/mysql-bin.log
 binlog_do_db=sakila
+relay-log=/var/log/mysql/mysql-relay-bin.log
 EOF'
 """,
-        "sudo systemctl restart mysql",
-        # Create users for each replica
-        f"sudo mysql -u root -prootpass -e \"CREATE USER 'repl'@'{replica_ips[0]}' IDENTIFIED WITH mysql_native_password BY 'replpass';\"",
-        f"sudo mysql -u root -prootpass -e \"GRANT REPLICATION SLAVE ON *.* TO 'repl'@'{replica_ips[0]}';\"",
-        f"sudo mysql -u root -prootpass -e \"CREATE USER 'repl'@'{replica_ips[1]}' IDENTIFIED WITH mysql_native_password BY 'replpass';\"",
-        f"sudo mysql -u root -prootpass -e \"GRANT REPLICATION SLAVE ON *.* TO 'repl'@'{replica_ips[1]}';\"",
-        "sudo mysql -u root -prootpass -e 'FLUSH PRIVILEGES;'",
-        "sudo mysql -u root -prootpass -e 'exit'"
-      ]
-      run_ssh_commands(instance['public_ip'], commands)    
-      log_file, log_pos = get_binary_log_coords(instance['public_ip'])
-    else:
-      commands = [
+    "sudo systemctl restart mysql",
+  ]
+
+
+def server_id_for(private_ip: str) -> int:
+  """
+  Derive a MySQL server id that stays unique as replicas come and go.
+  Args:
+    private_ip (str): Private IP address of the instance.
+  Returns:
+    int: Server id.
+  """
+  return int(ipaddress.ip_address(private_ip))
+
+
+def configure_manager_for_replication(manager, replica_ips: List) -> None:
+  """
+  Enable the binary log on the manager and create the replication users.
+  Args:
+    manager (dict): Manager instance as returned by launch_instance.
+    replica_ips (List[str]): Private IP addresses of the replicas.
+  Returns:
+    None
+  """
+  commands = [
+    f"sudo sed -i 's/^bind-address.*/bind-address={manager['private_ip']}/' /etc/mysql/mysql.conf.d/mysqld.cnf",
 f"""sudo bash -c 'cat >> /etc/mysql/mysql.conf.d/mysqld.cnf <<EOF
-server-id={count}
+server-id=1
 log_bin=/var/log/mysql/mysql-bin.log
 binlog_do_db=sakila
-relay-log=/var/log/mysql/mysql-relay-bin.log
 EOF'
 """,
-        "sudo systemctl restart mysql",
-        "sudo mysql -u root -prootpass -e 'STOP REPLICA;'",
-        f"sudo mysql -u root -prootpass -e \"CHANGE REPLICATION SOURCE TO SOURCE_HOST='{source_ip[0]}', SOURCE_USER='repl', SOURCE_PASSWORD='replpass', SOURCE_LOG_FILE='{log_file}', SOURCE_LOG_POS={log_pos};\"",
-        "sudo mysql -u root -prootpass -e 'START REPLICA;'",
-        "sudo mysql -u root -prootpass -e 'exit'"
-      ]
-      run_ssh_commands(instance['public_ip'], commands)    
-  
-    count += 1
+    "sudo systemctl restart mysql",
+  ]
+  # Create users for each replica
+  for replica_ip in replica_ips:
+    commands += replication_user_commands(replica_ip)
+  commands += [
+    "sudo mysql -u root -prootpass -e 'FLUSH PRIVILEGES;'",
+    "sudo mysql -u root -prootpass -e 'exit'"
+  ]
+  run_ssh_commands(manager['public_ip'], commands)
+
+
+def configure_db_for_replication(instances) -> List:
+  """
+  Set up the manager as replication source and seed every replica from one snapshot of it.
+  Args:
+    instances: Manager and replica instances as returned by launch_instance.
+  Returns:
+    List[dict]: Replicas that were seeded and are replicating.
+  """
+  manager = [inst for inst in instances if inst['is_master']][0]
+  replicas = [inst for inst in instances if not inst['is_master']]
+
+  configure_manager_for_replication(manager, [replica['private_ip'] for replica in replicas])
+  seeded = seed_replicas(manager, replicas)
+
+  failed = [r['private_ip'] for r in replicas if r not in seeded]
+  if failed:
+    print(f"Replicas that could not be seeded: {failed}")
+
+  return seeded
+
+
+def prepare_replica(replica) -> bool:
+  """
+  Wait for MySQL to be installed on a replica and enable its binary and relay logs.
+  Args:
+    replica (dict): Replica instance as returned by launch_instance.
+  Returns:
+    bool: True if the replica is ready to receive the snapshot.
+  """
+  commands = ["cloud-init status --wait"] + replica_config_commands(server_id_for(replica['private_ip'])) + [
+    "sudo mysql -u root -prootpass -e 'STOP REPLICA;'",
+  ]
+  try:
+    return run_ssh_command_and_wait(replica['public_ip'], " && ".join(cmd.strip() for cmd in commands)) == 0
+  except Exception as e:
+    print(f"Preparation failed on {replica['private_ip']}: {e}")
+    return False
+
+
+def get_snapshot_coords(host_ip: str):
+  """
+  Read the binary log coordinates recorded by mydumper in the snapshot's metadata file.
+  Both the old ('Log: ... Pos: ...') and the new ('File = ... Position = ...') layouts are supported.
+  Args:
+    host_ip (str): Public IP address of the manager holding the snapshot.
+  Returns:
+    tuple (log_file: str, log_pos: int): Coordinates matching the snapshot, or None if not found.
+  """
+  client = create_ssh_client(host_ip)
+  _, stdout, _ = client.exec_command(f"sudo cat {SNAPSHOT_DIR}/sakila/metadata")
+  metadata = stdout.read().decode("utf-8")
+  client.close()
+
+  log_file = re.search(r"(?:\bLog:|\bFile\s*=)\s*(\S+)", metadata)
+  log_pos = re.search(r"(?:\bPos:|\bPosition\s*=)\s*(\d+)", metadata)
+  if not log_file or not log_pos:
+    return None
+
+  return log_file.group(1), int(log_pos.group(1))
+
+
+def restore_on_replica(replica, manager_private_ip: str, log_file: str, log_pos: int) -> bool:
+  """
+  Fetch the snapshot from the manager over the private network, load it with
+  parallel myloader threads and start replication from the snapshot's coordinates.
+  Args:
+    replica (dict): Replica instance as returned by launch_instance.
+    manager_private_ip (str): Private IP address of the manager serving the snapshot.
+    log_file (str): Binary log file of the snapshot.
+    log_pos (int): Binary log position of the snapshot.
+  Returns:
+    bool: True if the snapshot was restored and replication started.
+  """
+  url = f"http://{manager_private_ip}:{SNAPSHOT_PORT}/{SNAPSHOT_FILE}"
+  commands = [
+    f"sudo rm -rf {SNAPSHOT_DIR} && sudo mkdir -p {SNAPSHOT_DIR}",
+    f"bash -o pipefail -c 'curl -sSf --retry 10 --retry-connrefused --retry-delay 1 {url} | sudo tar -x -C {SNAPSHOT_DIR}'",
+    f"sudo myloader -u root -p rootpass -d {SNAPSHOT_DIR}/sakila --threads {LOADER_THREADS} --overwrite-tables",
+    f"sudo rm -rf {SNAPSHOT_DIR}",
+    f"sudo mysql -u root -prootpass -e \"CHANGE REPLICATION SOURCE TO SOURCE_HOST='{manager_private_ip}', SOURCE_USER='repl', SOURCE_PASSWORD='replpass', SOURCE_LOG_FILE='{log_file}', SOURCE_LOG_POS={log_pos};\"",
+    "sudo mysql -u root -prootpass -e 'START REPLICA;'",
+  ]
+  try:
+    status = run_ssh_command_and_wait(replica['public_ip'], " && ".join(commands))
+  except Exception as e:
+    print(f"Restore failed on {replica['private_ip']}: {e}")
+    return False
+
+  if status != 0:
+    print(f"Restore failed on {replica['private_ip']}")
+  return status == 0
+
+
+def seed_replicas(manager, replicas: List) -> List:
+  """
+  Take one consistent snapshot of the manager with mydumper, have all replicas
+  fetch it in parallel over the private network, load it with myloader and
+  start replication from the snapshot's binlog coordinates.
+  Args:
+    manager (dict): Manager instance with at least 'public_ip' and 'private_ip'.
+    replicas (List[dict]): Replica instances as returned by launch_instance.
+  Returns:
+    List[dict]: Replicas that were seeded and are replicating.
+  """
+  with ThreadPoolExecutor(max_workers=max(len(replicas), 1)) as executor:
+    ready = list(executor.map(prepare_replica, replicas))
+  replicas = [replica for replica, ok in zip(replicas, ready) if ok]
+  if not replicas:
+    return []
+
+  print(f"Taking snapshot of {manager['private_ip']}")
+  if run_ssh_command_and_wait(manager['public_ip'], SNAPSHOT_COMMAND) != 0:
+    print("Snapshot of the manager failed")
+    return []
+
+  coords = get_snapshot_coords(manager['public_ip'])
+  if coords is None:
+    print("No binlog coordinates in the snapshot metadata")
+    run_ssh_commands(manager['public_ip'], [f"sudo rm -rf {SNAPSHOT_DIR}"])
+    return []
+  log_file, log_pos = coords
+
+  run_ssh_commands(manager['public_ip'], [
+    f"nohup python3 -m http.server {SNAPSHOT_PORT} --bind {manager['private_ip']} --directory {SNAPSHOT_DIR} "
+    f"> /dev/null 2>&1 & echo $! > {SNAPSHOT_DIR}.pid"
+  ])
+  try:
+    print(f"Restoring snapshot on {[r['private_ip'] for r in replicas]} from {log_file}:{log_pos}")
+    with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+      restored = list(executor.map(
+        lambda r: restore_on_replica(r, manager['private_ip'], log_file, log_pos), replicas
+      ))
+  finally:
+    run_ssh_commands(manager['public_ip'], [
+      f"kill $(cat {SNAPSHOT_DIR}.pid); sudo rm -rf {SNAPSHOT_DIR} {SNAPSHOT_DIR}.pid"
+    ])
+
+  return [replica for replica, ok in zip(replicas, restored) if ok]
+
+
+def scale_out(manager, proxy_ip: str, instance_name='worker', type='t2.micro', weight=1, role='read', api_key='secret123'):
+  """
+  Add a read replica to a running cluster: launch it, seed it from the manager,
+  attach it to the manager's binlog and register it with the proxy.
+  Args:
+    manager (dict): Manager instance with at least 'public_ip' and 'private_ip'.
+    proxy_ip (str): Public IP address of the proxy.
+    instance_name (str): Name tag of the new instance.
+    type (str): EC2 instance type of the new replica.
+    weight (int): Routing weight of the new worker on the proxy.
+    role (str): 'read' for point reads or 'analytics' for expensive reads.
+    api_key (str): Key of the proxy's worker admin API.
+  Returns:
+    new replica instance, or None if it could not be added
+  """
+  with open(MYSQL_SCRIPT_PATH) as f:
+    replica = launch_instance(instance_name=instance_name, type=type, user_data=f.read())
+  if replica is None:
+    return None
+
+  run_ssh_commands(manager['public_ip'], replication_user_commands(replica['private_ip']) + [
+    "sudo mysql -u root -prootpass -e 'FLUSH PRIVILEGES;'",
+  ])
+
+  if not seed_replicas(manager, [replica]):
+    print(f"Failed to seed {replica['private_ip']}, removing it")
+    remove_replica(manager, replica)
+    return None
+
+  try:
+    resp = requests.post(
+      f"http://{proxy_ip}:5000/workers",
+      headers={"x-api-key": api_key},
+      json={"host": replica['private_ip'], "weight": weight, "role": role}
+    )
+    registered = resp.ok
+    print(resp.text)
+  except requests.RequestException as e:
+    print(f"Error while registering {replica['private_ip']} with the proxy: {e}")
+    registered = False
+
+  if not registered:
+    print(f"Failed to register {replica['private_ip']} with the proxy, removing it")
+    remove_replica(manager, replica)
+    return None
+
+  return replica
+
+
+def remove_replica(manager, replica) -> None:
+  """
+  Undo a failed scale-out: drop the replica's replication user on the manager
+  and terminate its instance.
+  Args:
+    manager (dict): Manager instance with at least 'public_ip'.
+    replica (dict): Replica instance as returned by launch_instance.
+  Returns:
+    None
+  """
+  run_ssh_commands(manager['public_ip'], [
+    f"sudo mysql -u root -prootpass -e \"DROP USER IF EXISTS 'repl'@'{replica['private_ip']}';\"",
+  ])
+  terminate_instance(replica['instance_id'])
 
 
 def run_flask_server(ip='', filename='', env_variables=''):
@@ -353,3 +629,24 @@ def terminate_instance(instance_id):
   except ClientError as e:
     print(f"Error during stopping : {e}")
     return False
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Manage the cluster instances")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  scale_out_parser = subparsers.add_parser("scale-out", help="Add a read replica to the running cluster")
+  scale_out_parser.add_argument("--manager-public-ip", required=True)
+  scale_out_parser.add_argument("--manager-private-ip", required=True)
+  scale_out_parser.add_argument("--proxy-ip", required=True, help="Public IP of the proxy")
+  scale_out_parser.add_argument("--name", default="worker")
+  scale_out_parser.add_argument("--type", default="t2.micro")
+  scale_out_parser.add_argument("--weight", type=int, default=1)
+  scale_out_parser.add_argument("--role", choices=["read", "analytics"], default="read")
+  scale_out_parser.add_argument("--api-key", default="secret123", help="Key of the proxy's worker admin API")
+
+  args = parser.parse_args()
+
+  if args.command == "scale-out":
+    manager = {'public_ip': args.manager_public_ip, 'private_ip': args.manager_private_ip}
+    scale_out(manager, args.proxy_ip, instance_name=args.name, type=args.type, weight=args.weight, role=args.role, api_key=args.api_key)
@@ -1,15 +1,23 @@
+import contextlib
+import csv
+import io
+import ipaddress
+import itertools
+import json
+import logging
 import pymysql
 import random
+import re
+import threading
 import time
 import os
 
-from collections import Counter
-from flask import Flask, request, jsonify
+from collections import Counter, OrderedDict
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 app = Flask(__name__)
 
 MANAGER_HOST = os.getenv("MANAGER_IP")
-WORKERS = os.getenv("WORKERS_IPS").split(",")
 DB_USER = "root"
 DB_PASS = "rootpass"
 DB_NAME = "sakila"
@@ -17,6 +25,114 @@ DB_NAME = "sakila"
 MODE = "direct"
 stats = Counter()
 
+# The worker admin API requires the same key as the gatekeeper and only
+# accepts workers inside the VPC (AWS default VPC range by default)
+API_KEY = os.getenv("API_KEY", "secret123")
+VPC_NETWORK = ipaddress.ip_network(os.getenv("VPC_CIDR", "172.31.0.0/16"))
+
+# Bulk loads: rows per multi-row INSERT and rows per transaction
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+BULK_COMMIT_SIZE = int(os.getenv("BULK_COMMIT_SIZE", "10000"))
+IDENTIFIER = re.compile(r"^\w+$")
+
+# Reads whose EXPLAIN cost reaches COST_THRESHOLD go to the analytics workers, or
+# through a lane of at most HEAVY_LANE_SIZE concurrent queries if there are none
+COST_THRESHOLD = float(os.getenv("COST_THRESHOLD", "1000"))
+EXPLAIN_CACHE_TTL = float(os.getenv("EXPLAIN_CACHE_TTL", "300"))
+# Failed estimates are retried quickly instead of pinning a shape as cheap
+EXPLAIN_FAILURE_TTL = float(os.getenv("EXPLAIN_FAILURE_TTL", "5"))
+EXPLAIN_CACHE_SIZE = 10000
+# Longest time a request waits for the EXPLAIN another request is running for the same shape
+EXPLAIN_WAIT_TIMEOUT = 5
+HEAVY_LANE_SIZE = int(os.getenv("HEAVY_LANE_SIZE", "2"))
+
+# Fraction of requests written to the trace log when the gatekeeper did not decide
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "proxy_trace.log")
+
+# The file handler is attached when the server starts, not on import
+trace_logger = logging.getLogger("trace")
+trace_logger.setLevel(logging.INFO)
+trace_logger.propagate = False
+
+# Worker registry: host -> {"label", "weight", "role", "state", "inflight"}
+# Workers are either "active" (eligible for reads) or "draining" (no new reads).
+# Their role is "read" (point reads) or "analytics" (expensive reads).
+WORKER_ROLES = ["read", "analytics"]
+workers = {}
+workers_lock = threading.Lock()
+worker_count = 0
+
+# Estimated cost per query fingerprint, least recently used first: fingerprint -> (cost, expiry).
+# explain_pending holds the shapes being estimated so that only one request runs their EXPLAIN.
+explain_cache = OrderedDict()
+explain_pending = {}
+explain_cache_lock = threading.Lock()
+heavy_lane = threading.BoundedSemaphore(HEAVY_LANE_SIZE)
+
+class StageTimer:
+  """
+  Record the duration of consecutive request stages using a monotonic clock.
+  """
+
+  def __init__(self):
+    self.timings = []
+    self._last = time.perf_counter()
+
+  def mark(self, stage):
+    """
+    Close the current stage and start the next one.
+    Args:
+      stage (str): Name of the stage that just ended.
+    Returns:
+      None
+    """
+    now = time.perf_counter()
+    self.timings.append((stage, (now - self._last) * 1000))
+    self._last = now
+
+  def server_timing(self):
+    """
+    Format the recorded stages as a Server-Timing header value.
+    Returns:
+      str: Header value such as 'select;dur=0.12, execute;dur=3.40'.
+    """
+    return ", ".join(f"{stage};dur={dur:.2f}" for stage, dur in self.timings)
+
+
+def traced_response(body, status, timer, trace_id, sampled, host=None):
+  """
+  Encode a JSON response, attach the trace headers and log the trace if sampled.
+  Args:
+    body (dict): JSON body of the response.
+    status (int): HTTP status code.
+    timer (StageTimer): Timer holding the stages of the request.
+    trace_id (str): Trace ID propagated by the gatekeeper.
+    sampled (bool): Whether the request is written to the trace log.
+    host (str, optional): Database host that served the query.
+  Returns:
+    Flask Response: JSON response with Server-Timing and X-Trace-Id headers.
+  """
+  resp = jsonify(body)
+  resp.status_code = status
+  timer.mark("encode")
+
+  resp.headers["Server-Timing"] = timer.server_timing()
+  if trace_id:
+    resp.headers["X-Trace-Id"] = trace_id
+
+  if sampled:
+    trace_logger.info(json.dumps({
+      "trace_id": trace_id,
+      "ts": time.time(),
+      "status": status,
+      "host": host,
+      "timings": {stage: round(dur, 3) for stage, dur in timer.timings}
+    }))
+
+  return resp
+
+
 def get_conn(host):
   """
   Create and return a MySQL database connection to the specified host.
@@ -45,28 +161,220 @@ def is_write_query(query: str) -> bool:
   return q.startswith("insert") or q.startswith("update") or q.startswith("delete") or q.startswith("create")
 
 
+def register_worker(host, weight=1, role="read"):
+  """
+  Add a worker to the registry or update the weight and role of an existing one.
+  Args:
+    host (str): IP address of the replica to register.
+    weight (int): Relative share of reads sent to this worker in random mode.
+    role (str): 'read' for point reads or 'analytics' for expensive reads.
+  Returns:
+    dict: Registry entry of the worker.
+  """
+  global worker_count
+
+  with workers_lock:
+    if host in workers:
+      workers[host]["weight"] = weight
+      workers[host]["role"] = role
+      workers[host]["state"] = "active"
+    else:
+      worker_count += 1
+      workers[host] = {
+        "label": f"worker{worker_count}",
+        "weight": weight,
+        "role": role,
+        "state": "active",
+        "inflight": 0
+      }
+    return dict(workers[host])
+
+
+def active_workers(role=None):
+  """
+  List the workers currently eligible to receive reads.
+  Args:
+    role (str, optional): Only list workers with this role.
+  Returns:
+    list[tuple(str, int)]: (host, weight) pairs of active workers.
+  """
+  with workers_lock:
+    return [
+      (host, w["weight"]) for host, w in workers.items()
+      if w["state"] == "active" and (role is None or w["role"] == role)
+    ]
+
+
+def random_worker(role="read"):
+  """
+  Pick an active worker at random, proportionally to its weight.
+  Args:
+    role (str): Role of the workers to pick from. Any active worker is used if none has it.
+  Returns:
+    str: IP address of the chosen worker, or the manager if no worker is active.
+  """
+  candidates = active_workers(role) or active_workers()
+  if not candidates:
+    return MANAGER_HOST
+
+  hosts, weights = zip(*candidates)
+  return random.choices(hosts, weights=weights)[0]
+
+
 def fastest_worker():
   """
-  Identify the worker with the lowest current connection latency.
+  Identify the worker with the lowest current connection latency, divided by its
+  weight so that a worker of weight 2 wins against one of weight 1 up to twice its latency.
   Returns:
     str: IP address of the fastest worker host. Falls back to a random worker if latency checks fail.
   """
   best = None
   best_time = 99999
 
-  for host in WORKERS:
+  for host, weight in active_workers("read") or active_workers():
     start = time.time()
     try:
       conn = get_conn(host)
       conn.close()
-      latency = time.time() - start
+      latency = (time.time() - start) / weight
       if latency < best_time:
         best_time = latency
         best = host
     except:
       continue
 
-  return best or random.choice(WORKERS)
+  return best or random_worker()
+
+
+def fingerprint(sql):
+  r"""
+  Normalize a query to its shape by replacing literals with placeholders
+  and removing the spacing around operators and punctuation.
+  Args:
+    sql (str): SQL query string.
+  Returns:
+    str: Normalized query.
+
+  >>> fingerprint("SELECT * FROM actor WHERE actor_id = 5;")
+  'select * from actor where actor_id=?'
+  >>> fingerprint("select * from actor where actor_id=42")
+  'select * from actor where actor_id=?'
+  >>> fingerprint("SELECT a FROM film WHERE title = 'It\\'s' AND id IN (1, 2,3) AND x>=1.5")
+  'select a from film where title=? and id in(?+) and x>=?'
+  >>> fingerprint("select  n\nfrom t2 where name=\"x\"")
+  'select n from t2 where name=?'
+  """
+  q = sql.strip().rstrip(";").lower()
+  q = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", "?", q)
+  q = re.sub(r"\b\d+(?:\.\d+)?\b", "?", q)
+  q = re.sub(r"\s*([=<>!,+\-/%])\s*", r"\1", q)
+  q = re.sub(r"\s*\(\s*", "(", q)
+  q = re.sub(r"\s*\)", ")", q)
+  q = re.sub(r"\(\?(?:,\?)*\)", "(?+)", q)
+  return re.sub(r"\s+", " ", q)
+
+
+def plan_cost(query_block):
+  """
+  Extract the estimated cost from a query block of EXPLAIN FORMAT=JSON.
+  UNION plans have no cost at the top level: the cost of their parts is summed.
+  Args:
+    query_block (dict): 'query_block' object of the plan.
+  Returns:
+    float: Estimated query cost.
+  Raises:
+    ValueError: If the plan holds no cost estimate.
+
+  >>> plan_cost({"cost_info": {"query_cost": "12.50"}})
+  12.5
+  >>> plan_cost({"union_result": {"query_specifications": [
+  ...   {"query_block": {"cost_info": {"query_cost": "1.00"}}},
+  ...   {"query_block": {"cost_info": {"query_cost": "2.50"}}}]}})
+  3.5
+  """
+  cost_info = query_block.get("cost_info", {})
+  if "query_cost" in cost_info:
+    return float(cost_info["query_cost"])
+
+  specs = query_block.get("union_result", {}).get("query_specifications", [])
+  if not specs:
+    raise ValueError("No cost estimate in plan")
+  return sum(plan_cost(spec["query_block"]) for spec in specs)
+
+
+def explain_cost(sql, host):
+  """
+  Ask MySQL for the estimated cost of a query.
+  Args:
+    sql (str): SELECT query to estimate.
+    host (str): Database host on which to run EXPLAIN.
+  Returns:
+    float: Estimated query cost, or None if it could not be estimated.
+  """
+  conn = None
+  try:
+    conn = get_conn(host)
+    cur = conn.cursor()
+    cur.execute(f"EXPLAIN FORMAT=JSON {sql}")
+    plan = json.loads(cur.fetchone()[0])
+    return plan_cost(plan["query_block"])
+  except Exception:
+    return None
+  finally:
+    if conn:
+      conn.close()
+
+
+def is_expensive(sql):
+  """
+  Decide whether a read is expensive, running EXPLAIN once per query shape
+  and caching the estimated cost for EXPLAIN_CACHE_TTL seconds. Shapes whose
+  cost could not be estimated are treated as cheap for EXPLAIN_FAILURE_TTL seconds.
+  The cache evicts the least recently used shapes once it holds EXPLAIN_CACHE_SIZE
+  of them, and concurrent misses on a shape wait for a single EXPLAIN.
+  Args:
+    sql (str): Read query.
+  Returns:
+    bool: True if the estimated cost reaches COST_THRESHOLD.
+  """
+  if not sql.strip().lower().startswith("select"):
+    return False
+
+  key = fingerprint(sql)
+  with explain_cache_lock:
+    cached = explain_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+      explain_cache.move_to_end(key)
+      return cached[0] is not None and cached[0] >= COST_THRESHOLD
+
+    pending = explain_pending.get(key)
+    if pending is None:
+      pending = explain_pending[key] = threading.Event()
+      running = True
+    else:
+      running = False
+
+  if not running:
+    # Another request is estimating this shape: reuse its result (cheap if it is too slow)
+    pending.wait(EXPLAIN_WAIT_TIMEOUT)
+    with explain_cache_lock:
+      cached = explain_cache.get(key)
+    return bool(cached) and cached[0] is not None and cached[0] >= COST_THRESHOLD
+
+  cost = None
+  try:
+    cost = explain_cost(sql, random_worker())
+  finally:
+    ttl = EXPLAIN_CACHE_TTL if cost is not None else EXPLAIN_FAILURE_TTL
+    with explain_cache_lock:
+      explain_cache[key] = (cost, time.monotonic() + ttl)
+      explain_cache.move_to_end(key)
+      while len(explain_cache) > EXPLAIN_CACHE_SIZE:
+        explain_cache.popitem(last=False)
+      del explain_pending[key]
+    pending.set()
+
+  return cost is not None and cost >= COST_THRESHOLD
 
 
 def get_hostname(host):
@@ -77,15 +385,136 @@ def get_hostname(host):
   Returns:
     str: Logical hostname string such as 'manager', 'worker1', or 'worker2'.
   """
-  hostname = ''
   if host == MANAGER_HOST:
-    hostname = 'manager'
-  elif host == WORKERS[0]:
-      hostname = 'worker1'
-  else:
-    hostname = 'worker2'
+    return 'manager'
+
+  with workers_lock:
+    worker = workers.get(host)
+    return worker["label"] if worker else 'unknown'
+
+
+def get_role(host):
+  """
+  Return the role of a registered worker.
+  Args:
+    host (str): IP address of the worker.
+  Returns:
+    str: 'read' or 'analytics', or None if the host is not a registered worker.
+  """
+  with workers_lock:
+    worker = workers.get(host)
+    return worker["role"] if worker else None
+
 
-  return hostname
+def track_inflight(host, delta):
+  """
+  Adjust the number of queries currently running on a worker.
+  Args:
+    host (str): IP address of the worker.
+    delta (int): +1 when a query starts, -1 when it ends.
+  Returns:
+    None
+  """
+  with workers_lock:
+    if host in workers:
+      workers[host]["inflight"] += delta
+
+
+@app.route("/workers", methods=["GET"])
+def list_workers():
+  """
+  List the registered workers with their weight, state and in-flight queries.
+  Returns:
+    Flask Response: JSON object keyed by worker IP.
+  """
+  key = request.headers.get("x-api-key")
+  if key != API_KEY:
+    return jsonify({"error": "Unauthorized"}), 403
+
+  with workers_lock:
+    return jsonify({host: dict(w) for host, w in workers.items()}), 200
+
+
+@app.route("/workers", methods=["POST"])
+def add_worker():
+  """
+  Register a new worker (or re-activate / re-weight / change the role of an existing one).
+  Returns:
+    Flask Response: JSON response with the worker entry or an error message.
+  """
+  key = request.headers.get("x-api-key")
+  if key != API_KEY:
+    return jsonify({"error": "Unauthorized"}), 403
+
+  body = request.get_json(silent=True) or {}
+  host = body.get("host")
+  weight = body.get("weight", 1)
+  role = body.get("role", "read")
+
+  if not host:
+    return jsonify({"error": "Missing host"}), 400
+  try:
+    in_vpc = ipaddress.ip_address(host) in VPC_NETWORK
+  except ValueError:
+    in_vpc = False
+  if not in_vpc:
+    return jsonify({"error": f"Host must be an IP address in {VPC_NETWORK}"}), 400
+  if not isinstance(weight, int) or isinstance(weight, bool) or weight < 1:
+    return jsonify({"error": "Weight must be a positive integer"}), 400
+  if role not in WORKER_ROLES:
+    return jsonify({"error": "Invalid role"}), 400
+
+  worker = register_worker(host, weight, role)
+  return jsonify({"message": "worker registered", "host": host, "worker": worker}), 200
+
+
+@app.route("/workers/<host>/drain", methods=["POST"])
+def drain_worker(host):
+  """
+  Stop routing new reads to a worker while letting in-flight queries finish.
+  Args:
+    host (str): IP address of the worker to drain.
+  Returns:
+    Flask Response: JSON response with the worker entry or an error message.
+  """
+  key = request.headers.get("x-api-key")
+  if key != API_KEY:
+    return jsonify({"error": "Unauthorized"}), 403
+
+  with workers_lock:
+    if host not in workers:
+      return jsonify({"error": "Unknown worker"}), 404
+    workers[host]["state"] = "draining"
+    worker = dict(workers[host])
+
+  return jsonify({"message": "worker draining", "host": host, "worker": worker}), 200
+
+
+@app.route("/workers/<host>", methods=["DELETE"])
+def remove_worker(host):
+  """
+  Remove a worker from the registry. The worker must be drained and idle
+  unless `force=true` is passed as a query parameter.
+  Args:
+    host (str): IP address of the worker to remove.
+  Returns:
+    Flask Response: JSON response confirming the removal or an error message.
+  """
+  key = request.headers.get("x-api-key")
+  if key != API_KEY:
+    return jsonify({"error": "Unauthorized"}), 403
+
+  force = request.args.get("force", "").lower() == "true"
+
+  with workers_lock:
+    worker = workers.get(host)
+    if not worker:
+      return jsonify({"error": "Unknown worker"}), 404
+    if not force and (worker["state"] != "draining" or worker["inflight"] > 0):
+      return jsonify({"error": "Worker must be drained and idle before removal", "worker": dict(worker)}), 409
+    del workers[host]
+
+  return jsonify({"message": "worker removed", "host": host}), 200
 
 
 @app.route("/set_mode", methods=["POST"])
@@ -132,44 +561,220 @@ def query():
   """
   global MODE
 
+  timer = StageTimer()
+  trace_id = request.headers.get("X-Trace-Id")
+  sampled_header = request.headers.get("X-Trace-Sampled")
+  if sampled_header is None:
+    sampled = random.random() < TRACE_SAMPLE_RATE
+  else:
+    sampled = sampled_header == "1"
+
   data = request.json
   sql = data.get("query")
 
   if not sql:
-    return jsonify({"error": "Missing query"}), 400
+    return traced_response({"error": "Missing query"}, 400, timer, trace_id, sampled)
 
+  target_host = None
   try:
-    target_host = None
+    lane = contextlib.nullcontext()
     if is_write_query(sql):
       target_host = MANAGER_HOST
     else:
       if MODE == "direct":
         target_host = MANAGER_HOST
 
-      elif MODE == "random":
-        target_host = random.choice(WORKERS)
+      else:
+        heavy = is_expensive(sql)
+        timer.mark("cost")
+
+        if heavy and active_workers("analytics"):
+          target_host = random_worker("analytics")
 
-      elif MODE == "custom":
-        target_host = fastest_worker()
+        elif MODE == "random":
+          target_host = random_worker()
+
+        elif MODE == "custom":
+          target_host = fastest_worker()
+
+        # Without analytics workers, expensive reads share a small concurrency lane
+        if heavy and target_host != MANAGER_HOST and get_role(target_host) != "analytics":
+          lane = heavy_lane
     
     hostname = get_hostname(target_host)
     stats[f'{target_host} ({hostname})'] += 1
+    timer.mark("select")
 
-    conn = get_conn(target_host)
+    track_inflight(target_host, 1)
+    try:
+      with lane:
+        timer.mark("lane")
+        conn = get_conn(target_host)
+        timer.mark("connect")
 
-    cur = conn.cursor()
-    cur.execute(sql)
+        cur = conn.cursor()
+        cur.execute(sql)
+        timer.mark("execute")
 
-    if is_write_query(sql):
-      conn.commit()
+        if is_write_query(sql):
+          conn.commit()
+          timer.mark("commit")
 
-    result = cur.fetchall()
-    conn.close()
+        result = cur.fetchall()
+        conn.close()
+        timer.mark("fetch")
+    finally:
+      track_inflight(target_host, -1)
 
-    return jsonify({"result": result}), 200
+    return traced_response({"result": result}, 200, timer, trace_id, sampled, target_host)
 
   except Exception as e:
-    return jsonify({"error": str(e)}), 500
+    timer.mark("error")
+    return traced_response({"error": str(e)}, 500, timer, trace_id, sampled, target_host)
+
+
+def iter_records(stream, fmt):
+  """
+  Read the column names and lazily iterate over the rows of a CSV or NDJSON body.
+  CSV bodies start with a header row and use \\N for NULL, NDJSON bodies
+  take their columns from the keys of the first record and every other
+  record must have exactly the same keys.
+  Args:
+    stream (file-like): Binary request body.
+    fmt (str): Either 'csv' or 'ndjson'.
+  Returns:
+    tuple(list[str], iterator): Column names and an iterator of row tuples.
+  Raises:
+    ValueError: If the first NDJSON record is not a JSON object, or when iterating
+      over a later record that is not an object or has different keys.
+  """
+  text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+
+  if fmt == "csv":
+    reader = csv.reader(text)
+    columns = next(reader, [])
+    rows = (tuple(None if v == "\\N" else v for v in row) for row in reader if row)
+    return columns, rows
+
+  records = (json.loads(line) for line in text if line.strip())
+  first = next(records, None)
+  if first is None:
+    return [], iter(())
+
+  if not isinstance(first, dict):
+    raise ValueError("Records must be JSON objects")
+
+  columns = list(first.keys())
+
+  def rows():
+    for n, record in enumerate(itertools.chain([first], records), 1):
+      if not isinstance(record, dict):
+        raise ValueError(f"Row {n} is not a JSON object")
+      if record.keys() != first.keys():
+        raise ValueError(f"Row {n} has keys {sorted(record)}, expected {sorted(columns)}")
+      yield tuple(record[c] for c in columns)
+
+  return columns, rows()
+
+
+@app.route("/bulk/<table>", methods=["POST"])
+def bulk_load(table):
+  """
+  Stream a CSV or NDJSON body into a table of the manager using multi-row inserts.
+  Query parameters: format ('csv' or 'ndjson', guessed from the Content-Type
+  otherwise), batch_size (rows per INSERT) and commit_size (rows per transaction).
+  Args:
+    table (str): Name of the table to load.
+  Returns:
+    Flask Response: NDJSON stream with one progress line per commit and a final summary line,
+    or a 400 error if the body has no rows, a bad header or invalid column names.
+  """
+  fmt = request.args.get("format") or ("ndjson" if "json" in (request.content_type or "") else "csv")
+  if fmt not in ["csv", "ndjson"]:
+    return jsonify({"error": "Invalid format"}), 400
+
+  if not IDENTIFIER.match(table):
+    return jsonify({"error": "Invalid table name"}), 400
+
+  try:
+    batch_size = int(request.args.get("batch_size", BULK_BATCH_SIZE))
+    commit_size = int(request.args.get("commit_size", BULK_COMMIT_SIZE))
+  except ValueError:
+    return jsonify({"error": "batch_size and commit_size must be integers"}), 400
+  if batch_size < 1 or commit_size < 1:
+    return jsonify({"error": "batch_size and commit_size must be positive"}), 400
+
+  # Read the header (or first record) now so malformed bodies get a 400, not an error line
+  try:
+    columns, rows = iter_records(request.stream, fmt)
+  except (ValueError, csv.Error) as e:
+    return jsonify({"error": f"Invalid body: {e}"}), 400
+  if not columns:
+    return jsonify({"error": "Empty body"}), 400
+  for column in columns:
+    if not IDENTIFIER.match(column):
+      return jsonify({"error": f"Invalid column name: {column}"}), 400
+
+  # Bulk loads are writes: they always go to the manager
+  target_host = MANAGER_HOST
+  stats[f'{target_host} ({get_hostname(target_host)})'] += 1
+  trace_id = request.headers.get("X-Trace-Id")
+
+  def generate():
+    start = time.perf_counter()
+    conn = None
+    loaded = 0
+    committed = 0
+    try:
+      column_list = ", ".join(f"`{c}`" for c in columns)
+      placeholders = ", ".join(["%s"] * len(columns))
+      # executemany turns this into multi-row INSERT statements
+      sql = f"INSERT INTO `{table}` ({column_list}) VALUES ({placeholders})"
+
+      conn = get_conn(target_host)
+      cur = conn.cursor()
+
+      batch = []
+      for row in rows:
+        if len(row) != len(columns):
+          raise ValueError(f"Row {loaded + len(batch) + 1} has {len(row)} values, expected {len(columns)}")
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+          cur.executemany(sql, batch)
+          loaded += len(batch)
+          batch = []
+
+          if loaded - committed >= commit_size:
+            conn.commit()
+            committed = loaded
+            yield json.dumps({"committed": committed, "elapsed": round(time.perf_counter() - start, 3)}) + "\n"
+
+      if batch:
+        cur.executemany(sql, batch)
+        loaded += len(batch)
+      conn.commit()
+      committed = loaded
+
+      yield json.dumps({"done": True, "committed": committed, "elapsed": round(time.perf_counter() - start, 3)}) + "\n"
+
+    except Exception as e:
+      if conn:
+        conn.rollback()
+      yield json.dumps({"error": str(e), "committed": committed}) + "\n"
+
+    finally:
+      if conn:
+        conn.close()
+
+  headers = {"X-Trace-Id": trace_id} if trace_id else {}
+  return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers=headers)
+
+
+if __name__ == "__main__":
+  trace_logger.addHandler(logging.FileHandler(TRACE_LOG_PATH))
 
+  for ip in filter(None, os.getenv("WORKERS_IPS", "").split(",")):
+    register_worker(ip.strip())
 
-app.run(host="0.0.0.0", port=5000)
+  app.run(host="0.0.0.0", port=5000)
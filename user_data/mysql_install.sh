@@ -0,0 +1,12 @@
+#!/bin/bash
+sudo apt update -y
+sudo apt install mysql-server -y
+
+sudo systemctl start mysql
+sudo systemctl enable mysql
+
+sudo mysql -e "CREATE USER 'root'@'%' IDENTIFIED WITH mysql_native_password BY 'rootpass'; FLUSH PRIVILEGES;"
+sudo mysql -e "GRANT ALL PRIVILEGES ON *.* TO 'root'@'%' WITH GRANT OPTION; FLUSH PRIVILEGES;"
+
+# Install dependencies
+sudo apt install mydumper -y
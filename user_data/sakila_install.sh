@@ -9,7 +9,7 @@ sudo mysql -e "CREATE USER 'root'@'%' IDENTIFIED WITH mysql_native_password BY '
 sudo mysql -e "GRANT ALL PRIVILEGES ON *.* TO 'root'@'%' WITH GRANT OPTION; FLUSH PRIVILEGES;"
 
 # Install dependencies
-sudo apt install sysbench wget unzip -y
+sudo apt install sysbench wget unzip mydumper -y
 
 wget https://downloads.mysql.com/docs/sakila-db.zip
 unzip sakila-db.zip